@@ -1,89 +1,202 @@
 import hashlib
 import json
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from textwrap import dedent
-from time import time
+from time import time_ns
 from uuid import uuid4
 from urllib.parse import urlparse
 import requests
+from orjson import JSONDecodeError, dumps as odumps, loads as oloads
 
-from flask import Flask, jsonify, request
+from flask import Flask, current_app, request
+
+# Built once rather than per call: json.dumps(block, sort_keys=True) constructs a fresh JSONEncoder every time.
+# Its output is identical, so block hashes stay compatible with other nodes.
+# Block hashes are kept as raw digest bytes and only turned into hex when serialized, here and in _json
+_block_encoder = json.JSONEncoder(sort_keys=True, default=bytes.hex)
+# the only form a hash takes on the wire, anything else would re-serialize differently and can't be a valid link
+_hex_hash = re.compile('[0-9a-f]{64}')
+
+
+def _json(obj, status=200):
+    """Builds a json response with orjson, a drop in for flask's jsonify which goes through the stdlib json module
+    :param obj: Object to serialize
+    :param status: <int> HTTP status code
+    :return: <Response>
+    """
+    return current_app.response_class(odumps(obj, default=bytes.hex), status=status, mimetype='application/json')
+
+
+def _is_int64(value):
+    """orjson only handles integers that fit in 64 bits, amounts and block fields have to stay within that range
+    :param value: Value to check
+    :return: <bool> True if value is an int (not a bool) that fits in a signed 64 bit integer
+    """
+    return type(value) is int and -2 ** 63 <= value < 2 ** 63
+
+
+def _json_body():
+    """Parses the request body with orjson, the routes all expect a json object
+    :return: <dict> or None if the body is not valid json or not a json object
+    """
+    try:
+        values = oloads(request.get_data())
+    except JSONDecodeError:
+        return None
+    return values if isinstance(values, dict) else None
 
 
 class Blockchain:
+    #: Number of consecutive proofs handed to a proof of work worker in one go
+    POW_WINDOW = 1 << 14
+    #: Seconds to wait on a neighbouring node before giving up on its chain
+    PEER_TIMEOUT = 5
+    #: Upper bound on the number of neighbouring nodes fetched from at the same time
+    MAX_PEER_FETCHES = 16
 
     def __init__(self):
         self.chain = []
-        self.current_transactions = []
+        # pending transactions are kept column-wise, one list per field, and only turned into dicts once per block
+        self._pending_senders, self._pending_recipients, self._pending_amounts = [], [], []
+        # guards the chain and pending transactions when the node serves requests from several threads,
+        # re-entrant so forge_block can call new_transaction and new_block while holding it
+        self._lock = threading.RLock()
         self.new_block(previous_hash=1, proof=100)
-        self.nodes = set()
+        # node netloc -> peer id, the id is the node's position in _peers which keeps registration order
+        self.nodes = {}
+        self._peers = []
+        self.pow_workers = os.cpu_count() or 1
+        self._pow_pool = None
 
     def register_node(self, address):
         """Add a new node to the list of nodes
         :param address: <str> Address of node. Eg. 'http://192.168.0.5:5000'
         :return: None
         """
-        parsed_url = urlparse(address)
-        self.nodes.add(parsed_url.netloc)
+        netloc = urlparse(address).netloc
+        with self._lock:
+            if netloc not in self.nodes:
+                self.nodes[netloc] = len(self._peers)
+                self._peers.append(netloc)
 
     def valid_chain(self, chain):
         """Determine if a given blockchain is valid
         :param chain: <list> A blockchain
         :return: <bool> True or False if Valid
         """
-        last_block = chain[0]
-        while current_index := 1 < len(chain):
-            block = chain[current_index]
-            if block['previous_hash'] != self_hash(last_block):
-                return False
-
-            if not self.valid_proof(last_block['proof'], block['proof']):
-                return False
+        # every block is hashed exactly once, then the links and proofs are checked pairwise
+        hashes = [self.hash(block) for block in chain[:-1]]
+        if [block['previous_hash'] for block in chain[1:]] != hashes:
+            return False
 
-            last_block = block
-            current_index += 1
-        return True
+        return all(self.valid_proof(last_block['proof'], block['proof']) for last_block, block in zip(chain, chain[1:]))
 
     def resolve_conflicts(self):
         """This is our Consensus Algorithm, it resolves conflicts by replacing our chain <-- longest one in the network.
         :return: <bool> True if our chain was replaced, False if not
         """
-        neighbours = self.nodes
+        neighbours = self._peers
         new_chain = None
         max_length = len(self.chain)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
+        # Grab the chains from all the nodes in our network concurrently, then verify them as they arrive
+        with ThreadPoolExecutor(max_workers=max(min(len(neighbours), self.MAX_PEER_FETCHES), 1)) as pool:
+            for chain in pool.map(self._fetch_chain, neighbours):
+                # the length a node reports is not trusted, only the blocks it actually sent count
+                if chain is not None and len(chain) > max_length and self.valid_chain(chain):
+                    max_length = len(chain)
                     new_chain = chain
 
         if new_chain:
-            self.chain = new_chain
+            with self._lock:
+                self.chain = new_chain
+                self._last_hash = self.hash(new_chain[-1])
             return True
         return False
 
+    @staticmethod
+    def _fetch_chain(node):
+        """Fetches the chain of a neighbouring node
+        :param node: <str> Address of node. Eg. '192.168.0.5:5000'
+        :return: <list> The chain or None if the node did not answer with a well formed chain
+        """
+        # an unreachable or misbehaving node is skipped, it must not abort the round for the other nodes
+        try:
+            response = requests.get(f'http://{node}/chain', timeout=Blockchain.PEER_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            chain = [Blockchain._block_from_json(block) for block in response.json()['chain']]
+            # whatever chain we adopt has to be servable again, this catches oversized ints anywhere in it
+            odumps(chain, default=bytes.hex)
+        except (requests.RequestException, KeyError, TypeError, ValueError):
+            return None
+        return chain
+
+    @staticmethod
+    def _block_from_json(block):
+        """Turns a block received as json back into our own representation, with previous_hash as digest bytes
+        :param block: <dict> Block as parsed from json
+        :return: <dict> Block
+        :raises ValueError: If the block is malformed
+        """
+        if not isinstance(block, dict) or 'previous_hash' not in block:
+            raise ValueError(f"Malformed block: {block!r}")
+        # valid_chain formats index and proof as integers, anything else can't be part of a valid chain.
+        # Integers must also fit in 64 bits or the adopted chain could no longer be served on /chain
+        if not _is_int64(block.get('index')) or not _is_int64(block.get('proof')):
+            raise ValueError(f"Malformed block: {block!r}")
+        transactions = block.get('transactions', [])
+        if not isinstance(transactions, list) or not all(
+                isinstance(tx, dict) and _is_int64(tx.get('amount')) for tx in transactions):
+            raise ValueError(f"Malformed transactions: {transactions!r}")
+
+        previous_hash = block['previous_hash']
+        if isinstance(previous_hash, str):
+            if not _hex_hash.fullmatch(previous_hash):
+                raise ValueError(f"Malformed previous_hash: {previous_hash!r}")
+            block = dict(block, previous_hash=bytes.fromhex(previous_hash))
+        return block
+
     def new_block(self, proof, previous_hash=None):
         """Create a new Block in the Blockchain
         :param proof: <int> The proof given by the Proof of Work algorithm
-        :param previous_hash: (Optional) <str> Hash of previous Block
+        :param previous_hash: (Optional) <bytes> Hash of previous Block
         :return: <dict> New Block
         """
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1])
-        }
-        self.current_transactions = []
-        self.chain.append(block)
+        with self._lock:
+            block = {
+                'index': len(self.chain) + 1,
+                # integer nanoseconds, json emits these as exact digits on every node unlike a float
+                'timestamp': time_ns(),
+                'transactions': self.current_transactions,
+                'proof': proof,
+                'previous_hash': previous_hash or self._last_hash
+            }
+            self._pending_senders, self._pending_recipients, self._pending_amounts = [], [], []
+            self.chain.append(block)
+            # blocks are never modified once on the chain, so the hash the next block links to can be kept
+            self._last_hash = self.hash(block)
         return block
 
+    def forge_block(self, last_block, proof, miner):
+        """Rewards the miner and forges a new Block on top of last_block, the block the proof was found for
+        :param last_block: <dict> Block the proof of work was done on
+        :param proof: <int> The proof found for last_block
+        :param miner: <str> Address of the node to reward
+        :return: <dict> New Block, or None if the chain moved on while the proof was being found
+        """
+        with self._lock:
+            # resolve_conflicts may have swapped the chain, the proof would not be valid on the new tip
+            if self.last_block is not last_block:
+                return None
+            self.new_transaction(sender="0", recipient=miner, amount=1)
+            return self.new_block(proof)
+
     def new_transaction(self, sender, recipient, amount):
         """Creates a new transaction to go into the next mined Block
         :param sender: <str> Address of the Sender
@@ -91,21 +204,42 @@ class Blockchain:
         :param amount: <int> Amount
         :return: <int> The index of the Block that will hold this transaction
         """
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount
-        })
-        return self.last_block['index'] + 1
+        with self._lock:
+            self._pending_senders.append(sender)
+            self._pending_recipients.append(recipient)
+            self._pending_amounts.append(amount)
+            return self.last_block['index'] + 1
+
+    def new_transactions(self, transactions):
+        """Creates several new transactions to go into the next mined Block in one go
+        :param transactions: <list> Transactions, each a dict with a sender, recipient and amount
+        :return: <int> The index of the Block that will hold these transactions
+        """
+        senders = [tx['sender'] for tx in transactions]
+        recipients = [tx['recipient'] for tx in transactions]
+        amounts = [tx['amount'] for tx in transactions]
+        with self._lock:
+            self._pending_senders.extend(senders)
+            self._pending_recipients.extend(recipients)
+            self._pending_amounts.extend(amounts)
+            return self.last_block['index'] + 1
 
     @staticmethod
     def hash(block):
         """Creates a SHA-256 hash of a Block
         :param block: <dict> Block
-        :return: <str>
+        :return: <bytes> Raw digest, hex encoded only when sent out as json
         """
-        block_string = json.dumps(block, sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        block_string = _block_encoder.encode(block).encode()
+        return hashlib.sha256(block_string).digest()
+
+    @property
+    def current_transactions(self):
+        """Returns the transactions waiting to go into the next mined Block"""
+        return [
+            {'sender': sender, 'recipient': recipient, 'amount': amount}
+            for sender, recipient, amount in zip(self._pending_senders, self._pending_recipients, self._pending_amounts)
+        ]
 
     @property
     def last_block(self):
@@ -116,13 +250,62 @@ class Blockchain:
         """Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains leading 4 zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
+        The search is split into windows of POW_WINDOW proofs which are scanned in order across pow_workers
+        processes, the first window holding a valid proof wins so the result matches a sequential scan.
         :param last_proof: <int>
         :return: <int>
         """
-        proof = 0
-        while self.valid_proof(last_proof, proof) is False:
-            proof += 1
-        return proof
+        window = self.POW_WINDOW
+        if self.pow_workers > 1:
+            self.start_pow_pool()
+            scan = self._pow_pool.map
+        else:
+            scan = map
+
+        start = 0
+        while True:
+            starts = range(start, start + self.pow_workers * window, window)
+            for proof in scan(self._scan_proofs, repeat(last_proof), starts, repeat(window)):
+                if proof is not None:
+                    return proof
+            start = starts.stop
+
+    def start_pow_pool(self):
+        """Starts the proof of work processes, entry points call this up front because starting them takes
+        far longer than mining a typical proof and would otherwise land on the first /mine request
+        :return: None
+        """
+        if self.pow_workers <= 1 or self._pow_pool is not None:
+            return
+
+        # forking a process that already serves requests on several threads can deadlock the children,
+        # forkserver starts the workers from a clean single threaded process instead
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._pow_pool = ProcessPoolExecutor(max_workers=self.pow_workers, mp_context=multiprocessing.get_context(method))
+        # the pool only starts processes as work arrives, an empty window per worker brings them all up now
+        list(self._pow_pool.map(self._scan_proofs, repeat(0), range(self.pow_workers), repeat(0)))
+
+    @staticmethod
+    def _scan_proofs(last_proof, start, window):
+        """Scans a window of proofs and returns the first valid one, this is the mining hot loop
+        :param last_proof: <int> Previous Proof
+        :param start: <int> First proof to try
+        :param window: <int> Number of proofs to try
+        :return: <int> or None if no proof in the window is valid
+        """
+        # hashlib.sha256 is OpenSSL's implementation, which already dispatches to SHA-NI at runtime
+        # when the cpu supports it. Everything the loop touches is bound to a local and the counter is
+        # driven by range, so each probe costs as little interpreter dispatch as possible.
+        # last_proof is the same for every guess, so it is absorbed once and each guess starts from a copy
+        # of that state, only feeding in the digits of proof
+        midstate = hashlib.sha256(b"%d" % last_proof).copy
+        for proof in range(start, start + window):
+            guess = midstate()
+            guess.update(b"%d" % proof)
+            guess_hash = guess.digest()
+            if guess_hash[0] == 0 and guess_hash[1] == 0:
+                return proof
+        return None
 
     @staticmethod
     def valid_proof(last_proof, proof):
@@ -131,18 +314,23 @@ class Blockchain:
         :param proof: <int> Current Proof
         :return: <bool> True if correct, False if not.
         """
-        guess = f"{last_proof}{proof}".encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        guess = b"%d%d" % (last_proof, proof)
+        # 4 leading hex zeroes are the first 2 raw bytes of the digest being zero, no need to hex encode
+        guess_hash = hashlib.sha256(guess).digest()
+        return guess_hash[0] == 0 and guess_hash[1] == 0
 
 
 class FrontEndFlaskApp:
     """Front end for the flask app, maps a series of http endpoints to backend (Blockchain) functionality"""
+    #: Request threads of the single gunicorn worker started by run_prod
+    PROD_THREADS = 8
 
     def __init__(self):
         self.app = Flask(__name__)
         self.node_identifier = str(uuid4()).replace('-', '')
         self.blockchain = Blockchain()
+        # only one request mines at a time, concurrent requests would just race to forge the same block
+        self._mine_lock = threading.Lock()
 
     def create_routes(self):
         """Create all the needed routes for the flask frontend to operate"""
@@ -151,9 +339,11 @@ class FrontEndFlaskApp:
         def register_nodes():
             """Register nodes to the blockchain"""
 
-            values = request.get_json()
+            values = _json_body()
+            if values is None:
+                return "Error: Please supply a valid json object", 400
             nodes = values.get('nodes')
-            if nodes is None:
+            if not isinstance(nodes, list) or not all(isinstance(node, str) for node in nodes):
                 return "Error: Please supply a valid list of nodes", 400
 
             for node in nodes:
@@ -161,25 +351,21 @@ class FrontEndFlaskApp:
 
             response = {
                 'message': 'New nodes have been added',
-                'total_nodes': [self.blockchain.nodes]
+                'total_nodes': list(self.blockchain.nodes)
             }
-            return jsonify(response), 201
+            return _json(response, 201)
 
         @self.app.route('/mine', methods=['GET'])
         def mine():
             """Mine a coin (forge a new block), payment of 1 coin is rewarded to the winning node for mining a block"""
 
-            last_block = self.blockchain.last_block
-            last_proof = last_block['proof']
-            proof = self.blockchain.proof_of_work(last_proof)
-
-            self.blockchain.new_transaction(
-                sender="0",
-                recipient=self.node_identifier,
-                amount=1
-            )
-            previous_hash = self.blockchain.hash(last_block)
-            block = self.blockchain.new_block(proof, previous_hash)
+            with self._mine_lock:
+                block = None
+                while block is None:
+                    last_block = self.blockchain.last_block
+                    last_proof = last_block['proof']
+                    proof = self.blockchain.proof_of_work(last_proof)
+                    block = self.blockchain.forge_block(last_block, proof, self.node_identifier)
 
             response = {
                 'message': "New Block Forged",
@@ -188,24 +374,50 @@ class FrontEndFlaskApp:
                 'proof': block['proof'],
                 'previous_hash': block['previous_hash'],
             }
-            return jsonify(response), 200
+            return _json(response, 200)
 
         @self.app.route('/transactions/new', methods=['POST'])
         def new_transaction():
             """Endpoint for creating a new transaction on the current block,
             Allows a sender to send an amount of coins to a recipient"""
 
-            values = request.get_json()
-            print(values)
+            values = _json_body()
+            if values is None:
+                return "Error: Please supply a valid json object", 400
+            self.app.logger.debug("new transaction: %s", values)
             required = ['sender', 'recipient', 'amount']
             if not all(k in values for k in required):
                 return 'Missing values', 400
+            if not _is_int64(values['amount']):
+                return 'Error: amount must be a 64 bit integer', 400
 
             sender, recipient, amount = values['sender'], values['recipient'], values['amount']
             index = self.blockchain.new_transaction(sender, recipient, amount)
 
             response = {'message': f'Transaction will be added to Block {index}'}
-            return jsonify(response), 201
+            return _json(response, 201)
+
+        @self.app.route('/transactions/batch', methods=['POST'])
+        def new_transactions():
+            """Endpoint for creating many transactions on the current block in a single request"""
+
+            values = _json_body()
+            if values is None:
+                return "Error: Please supply a valid json object", 400
+            transactions = values.get('transactions')
+            if not isinstance(transactions, list) or not all(isinstance(tx, dict) for tx in transactions):
+                return "Error: Please supply a valid list of transactions", 400
+
+            required = ['sender', 'recipient', 'amount']
+            if not all(k in tx for tx in transactions for k in required):
+                return 'Missing values', 400
+            if not all(_is_int64(tx['amount']) for tx in transactions):
+                return 'Error: amount must be a 64 bit integer', 400
+
+            index = self.blockchain.new_transactions(transactions)
+
+            response = {'message': f'{len(transactions)} transactions will be added to Block {index}'}
+            return _json(response, 201)
 
         @self.app.route('/chain', methods=['GET'])
         def full_chain():
@@ -215,7 +427,7 @@ class FrontEndFlaskApp:
                 'chain': self.blockchain.chain,
                 'length': len(self.blockchain.chain)
             }
-            return jsonify(resp)
+            return _json(resp)
 
         #after defining all routes, return self to allow method chaining --> instance.create_routes().run_<dev/prod>
         return self
@@ -223,11 +435,34 @@ class FrontEndFlaskApp:
     def run_dev(self):
         return self.app.run(host="0.0.0.0", port=5000)
 
-    def run_prod(self):
-        ...
+    @staticmethod
+    def run_prod():
+        """Replaces this process with gunicorn serving a fresh node built by create_app().
+        A node keeps its chain in memory, so there is a single worker process and concurrency comes from its threads,
+        mining is CPU bound and already fans out to its own process pool.
+        """
+        os.execvp('gunicorn', [
+            'gunicorn',
+            '--worker-class', 'gthread',
+            '--workers', '1',
+            '--threads', str(FrontEndFlaskApp.PROD_THREADS),
+            '--bind', '0.0.0.0:5000',
+            'blockchain:create_app()',
+        ])
+
+
+def create_app():
+    """Application factory, builds a node with all its routes and returns the flask app, this is the gunicorn entry point
+    :return: <Flask>
+    """
+    front_end = FrontEndFlaskApp()
+    front_end.blockchain.start_pow_pool()
+    return front_end.create_routes().app
+
 
 if __name__ == '__main__':
     front_end = FrontEndFlaskApp()
+    front_end.blockchain.start_pow_pool()
     front_end.create_routes().run_dev()
 
 
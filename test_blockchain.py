@@ -0,0 +1,178 @@
+from itertools import count
+
+import pytest
+
+from blockchain import Blockchain, FrontEndFlaskApp
+
+
+@pytest.fixture
+def blockchain():
+    blockchain = Blockchain()
+    blockchain.pow_workers = 1
+    for amount in range(2):
+        blockchain.new_transaction(sender='a', recipient='b', amount=amount)
+        blockchain.new_block(blockchain.proof_of_work(blockchain.last_block['proof']))
+    return blockchain
+
+
+@pytest.fixture
+def client():
+    return FrontEndFlaskApp().create_routes().app.test_client()
+
+
+def test_proof_of_work_process_pool_matches_sequential_scan():
+    blockchain = Blockchain()
+    blockchain.pow_workers = 2
+    # small windows so the scan crosses several rounds of the pool before it finds the proof
+    blockchain.POW_WINDOW = 1 << 10
+    try:
+        for last_proof in (100, 35293):
+            expected = next(proof for proof in count() if Blockchain.valid_proof(last_proof, proof))
+            assert blockchain.proof_of_work(last_proof) == expected
+    finally:
+        blockchain._pow_pool.shutdown()
+
+
+def test_valid_chain(blockchain):
+    assert blockchain.valid_chain(blockchain.chain)
+
+
+def test_valid_chain_rejects_tampered_previous_hash(blockchain):
+    chain = [dict(block) for block in blockchain.chain]
+    chain[2]['previous_hash'] = bytes(32)
+    assert not blockchain.valid_chain(chain)
+
+
+def test_valid_chain_rejects_tampered_proof(blockchain):
+    chain = [dict(block) for block in blockchain.chain]
+    chain[2]['proof'] += 1
+    assert not blockchain.valid_chain(chain)
+
+
+def test_block_from_json_round_trip(blockchain):
+    block = blockchain.last_block
+    as_json = dict(block, previous_hash=block['previous_hash'].hex())
+    assert Blockchain._block_from_json(as_json) == block
+
+
+@pytest.mark.parametrize('block', [
+    5,
+    {'index': 2},
+    {'previous_hash': 'AB' * 32},
+    {'previous_hash': 'ab ' * 21 + 'a'},
+    {'previous_hash': 'ab' * 31},
+    {'index': 2, 'previous_hash': 'ab' * 32},
+    {'index': 2, 'proof': 'x', 'previous_hash': 'ab' * 32},
+    {'index': '2', 'proof': 7, 'previous_hash': 'ab' * 32},
+    {'index': 2, 'proof': 2 ** 70, 'previous_hash': 'ab' * 32},
+    {'index': 2, 'proof': 7, 'previous_hash': 'ab' * 32, 'transactions': [{'amount': 2 ** 70}]},
+    {'index': 2, 'proof': 7, 'previous_hash': 'ab' * 32, 'transactions': [{'amount': 1.5}]},
+])
+def test_block_from_json_rejects_malformed_blocks(block):
+    with pytest.raises(ValueError):
+        Blockchain._block_from_json(block)
+
+
+def test_forge_block(blockchain):
+    last_block = blockchain.last_block
+    block = blockchain.forge_block(last_block, blockchain.proof_of_work(last_block['proof']), 'miner')
+    assert block is blockchain.last_block
+    assert block['transactions'][-1] == {'sender': '0', 'recipient': 'miner', 'amount': 1}
+    assert blockchain.valid_chain(blockchain.chain)
+
+
+def test_forge_block_refuses_a_stale_tip(blockchain):
+    last_block = blockchain.last_block
+    proof = blockchain.proof_of_work(last_block['proof'])
+    blockchain.chain = blockchain.chain[:2]
+    assert blockchain.forge_block(last_block, proof, 'miner') is None
+    assert len(blockchain.chain) == 2
+    assert blockchain.current_transactions == []
+
+
+class _PeerResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def _as_json(chain):
+    return [dict(block, previous_hash=block['previous_hash'].hex()) if block['index'] > 1 else block for block in chain]
+
+
+def test_resolve_conflicts_ignores_reported_length(blockchain, monkeypatch):
+    short = {'length': 99, 'chain': _as_json(blockchain.chain[:1])}
+    monkeypatch.setattr('blockchain.requests.get', lambda url, timeout: _PeerResponse(short))
+    blockchain.register_node('http://192.168.0.5:5000')
+    assert not blockchain.resolve_conflicts()
+    assert len(blockchain.chain) == 3
+
+
+def test_resolve_conflicts_skips_malformed_peers(blockchain, monkeypatch):
+    longer = Blockchain()
+    longer.pow_workers = 1
+    for _ in range(3):
+        longer.new_block(longer.proof_of_work(longer.last_block['proof']))
+    broken = _as_json(longer.chain)
+    broken[2] = dict(broken[2], proof='x')
+    peers = {
+        '192.168.0.5:5000': {'length': '99', 'chain': broken},
+        '192.168.0.6:5000': {'length': 4, 'chain': _as_json(longer.chain)},
+    }
+    monkeypatch.setattr('blockchain.requests.get', lambda url, timeout: _PeerResponse(peers[url.split('/')[2]]))
+    for node in peers:
+        blockchain.register_node(f'http://{node}')
+    assert blockchain.resolve_conflicts()
+    assert blockchain.chain == longer.chain
+
+
+def test_resolve_conflicts_skips_chains_that_cannot_be_served(blockchain, monkeypatch):
+    longer = Blockchain()
+    longer.pow_workers = 1
+    for _ in range(3):
+        longer.new_block(longer.proof_of_work(longer.last_block['proof']))
+    chain = _as_json(longer.chain)
+    chain[-1] = dict(chain[-1], transactions=[{'sender': 2 ** 70, 'recipient': 'b', 'amount': 1}])
+    monkeypatch.setattr('blockchain.requests.get', lambda url, timeout: _PeerResponse({'chain': chain}))
+    blockchain.register_node('http://192.168.0.5:5000')
+    assert not blockchain.resolve_conflicts()
+
+
+def test_register_nodes(client):
+    nodes = ['http://192.168.0.5:5000', 'http://192.168.0.6:5000', 'http://192.168.0.5:5000']
+    response = client.post('/nodes/register', json={'nodes': nodes})
+    assert response.status_code == 201
+    assert response.get_json()['total_nodes'] == ['192.168.0.5:5000', '192.168.0.6:5000']
+
+
+@pytest.mark.parametrize('body', [b'', b'not json', b'[1]', b'{"nodes": 5}', b'{"nodes": [5]}'])
+def test_register_nodes_rejects_bad_bodies(client, body):
+    assert client.post('/nodes/register', data=body).status_code == 400
+
+
+@pytest.mark.parametrize('amount', [b'123456789012345678901234567890', b'1.5', b'true', b'"1"'])
+def test_transactions_reject_amounts_outside_int64(client, amount):
+    transaction = b'{"sender": "a", "recipient": "b", "amount": %s}' % amount
+    assert client.post('/transactions/new', data=transaction).status_code == 400
+    assert client.post('/transactions/batch', data=b'{"transactions": [%s]}' % transaction).status_code == 400
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {'transactions': 5},
+    {'transactions': ['senderrecipientamount']},
+    {'transactions': [{'sender': 'a', 'recipient': 'b'}]},
+])
+def test_transactions_batch_rejects_bad_batches(client, body):
+    assert client.post('/transactions/batch', json=body).status_code == 400
+
+
+def test_transactions_batch(client):
+    transactions = [{'sender': 'a', 'recipient': 'b', 'amount': amount} for amount in range(3)]
+    response = client.post('/transactions/batch', json={'transactions': transactions})
+    assert response.status_code == 201
+    assert response.get_json() == {'message': '3 transactions will be added to Block 2'}